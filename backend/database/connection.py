@@ -1,5 +1,5 @@
-from pymongo import MongoClient
-from typing import Dict, List
+from motor.motor_asyncio import AsyncIOMotorClient
+from typing import Dict, List, Optional
 
 # MongoDBConnection class
 class MongoDBConnection:
@@ -7,12 +7,20 @@ class MongoDBConnection:
     This class handles the connection to the database and provides methods to interact with collections and documents.  
     """ 
 
-    def __init__(self, uri: str):
+    def __init__(self, uri: str, max_pool_size: int = 200, min_pool_size: int = 20,
+                 max_idle_time_ms: int = 60000, wait_queue_timeout_ms: int = 2000,
+                 server_selection_timeout_ms: int = 3000, socket_timeout_ms: int = 10000):
         """ 
         Constructor function to initialize the database connection.  
         
         Args:  
             uri (str): The connection string URI for the MongoDB database.  
+            max_pool_size (int): The maximum number of connections in the pool. Defaults to 200.  
+            min_pool_size (int): The number of connections kept open while idle, so bursts skip the TLS and auth handshakes. Defaults to 20.  
+            max_idle_time_ms (int): How long a connection may stay idle before it is closed. Defaults to 60000.  
+            wait_queue_timeout_ms (int): How long an operation may wait for a free connection when the pool is exhausted. Defaults to 2000.  
+            server_selection_timeout_ms (int): How long to wait for a suitable server before failing. Defaults to 3000.  
+            socket_timeout_ms (int): How long to wait for a response on a socket before failing. Defaults to 10000.  
         
         Returns:  
             None  
@@ -20,7 +28,17 @@ class MongoDBConnection:
         self.uri = uri
 
         try:
-            self.client = MongoClient(self.uri)
+            self.client = AsyncIOMotorClient(
+                self.uri,
+                maxPoolSize=max_pool_size,
+                minPoolSize=min_pool_size,
+                maxIdleTimeMS=max_idle_time_ms,
+                waitQueueTimeoutMS=wait_queue_timeout_ms,
+                serverSelectionTimeoutMS=server_selection_timeout_ms,
+                socketTimeoutMS=socket_timeout_ms,
+                retryWrites=True,
+                w="majority"
+            )
         except Exception as e:
             raise Exception(
                 "The following error occurred: ", e)
@@ -30,7 +48,7 @@ class MongoDBConnection:
         Retrieves the MongoDB client.  
         
         Returns:  
-            MongoClient: The MongoDB client instance.  
+            AsyncIOMotorClient: The MongoDB client instance.  
         """  
         client = self.client
         return client
@@ -62,7 +80,7 @@ class MongoDBConnection:
         collection = self.client[db_name][collection_name]
         return collection
 
-    def insert_one(self, db_name: str, collection_name: str, document: Dict,
+    async def insert_one(self, db_name: str, collection_name: str, document: Dict,
                    redefined_id: bool = False, id_attribute: str = None):
         """ 
         Inserts a single document into a collection.  
@@ -82,10 +100,10 @@ class MongoDBConnection:
             document['_id'] = document[id_attribute]
             del document[id_attribute]
 
-        result = self.client[db_name][collection_name].insert_one(document)
+        result = await self.client[db_name][collection_name].insert_one(document)
         return result
 
-    def insert_many(self, db_name: str, collection_name: str, documents: List[Dict],
+    async def insert_many(self, db_name: str, collection_name: str, documents: List[Dict],
                     redefined_id: bool = False, id_attribute: str = None):
         """ 
         Inserts multiple documents into a collection.  
@@ -106,5 +124,25 @@ class MongoDBConnection:
                 doc['_id'] = doc[id_attribute]
                 del doc[id_attribute]
 
-        result = self.client[db_name][collection_name].insert_many(documents)
+        result = await self.client[db_name][collection_name].insert_many(documents)
         return result
+
+
+# Process-wide connection, so every caller shares the same client and connection pool
+_connection: Optional[MongoDBConnection] = None
+
+
+def get_connection(uri: str) -> MongoDBConnection:
+    """ 
+    Retrieves the process-wide MongoDB connection, creating it on first use.  
+    
+    Args:  
+        uri (str): The connection string URI for the MongoDB database.  
+    
+    Returns:  
+        MongoDBConnection: The shared MongoDB connection instance.  
+    """
+    global _connection
+    if _connection is None:
+        _connection = MongoDBConnection(uri)
+    return _connection
@@ -0,0 +1,20 @@
+from bson import ObjectId
+
+# orjson serializes datetime natively, so only BSON-specific types need a fallback.
+# See https://github.com/ijl/orjson#default
+
+def orjson_default(o):
+    """Default hook for orjson to serialize ObjectId objects.
+
+    Args:
+        o (Any): The object orjson could not serialize natively.
+
+    Returns:
+        str: The string representation of the ObjectId.
+
+    Raises:
+        TypeError: If the object is not an ObjectId.
+    """
+    if isinstance(o, ObjectId):
+        return str(o)  # Convert ObjectId to string
+    raise TypeError
@@ -0,0 +1,26 @@
+import logging
+from typing import Union
+
+from pythonjsonlogger.json import JsonFormatter
+
+_configured = False
+
+
+def setup_logging(level: Union[int, str] = logging.INFO) -> None:
+    """Configure the root logger once per process to emit JSON records.
+
+    Values passed through the `extra` argument of a logging call are emitted as JSON fields.
+
+    Args:
+        level (Union[int, str]): The logging level, as a number or a name such as "WARNING". Defaults to logging.INFO.
+
+    Returns:
+        None
+    """
+    global _configured
+    if _configured:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    logging.basicConfig(level=level, handlers=[handler])
+    _configured = True
@@ -1,28 +1,40 @@
-from database.connection import MongoDBConnection
+from database.connection import get_connection
 from services.transactions_service import TransactionsService
-from encoder.json_encoder import MyJSONEncoder
+from encoder.orjson_default import orjson_default
+from logging_config import setup_logging
+from schemas import (
+    UserIdentifierRequest,
+    RecentTransactionsResponse,
+    AccountTransferRequest,
+    AccountTransferResponse,
+    DigitalPaymentRequest,
+    DigitalPaymentResponse,
+)
 
 import logging
 
-import json
-from pydantic import BaseModel
+import orjson
 from bson import ObjectId
+from pydantic import BaseModel, ValidationError
 
-from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 MONGODB_URI = os.getenv("MONGODB_URI")
+# Multi-document ACID transactions can be disabled for single replica set deployments
+USE_MONGO_TXN = os.getenv("USE_MONGO_TXN", "true").lower() != "false"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,36 +44,51 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.on_event("startup")
+def configure_logging():
+    setup_logging(LOG_LEVEL)
+
+
 # MongoDB connection
-connection = MongoDBConnection(MONGODB_URI)
+connection = get_connection(MONGODB_URI)
 
 # Set the database name
 db_name = "leafy_bank"
 
 # TransactionsService
-transactions_service = TransactionsService(connection, db_name)
+transactions_service = TransactionsService(connection, db_name, use_transactions=USE_MONGO_TXN)
 
 
-def validate_transaction_amount(data):
-    """Validate the transaction amount from the request data."""
-    try:
-        transaction_amount = float(data["transaction_amount"])
-    except ValueError:
-        raise HTTPException(
-            status_code=400, detail="Transaction amount must be a valid number.")
-
-    if transaction_amount <= 0:
-        raise HTTPException(
-            status_code=400, detail="Transaction amount must be greater than 0.")
-
-    transaction_limit = float(500)
-    if transaction_amount > transaction_limit:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Transaction amount exceeds the limit of {transaction_limit}. Please ensure the amount is {transaction_limit} or less."
-        )
+@app.on_event("startup")
+async def start_transactions_service():
+    await transactions_service.start()
+
+
+@app.on_event("shutdown")
+async def stop_transactions_service():
+    await transactions_service.stop()
 
-    return transaction_amount
+
+def json_body(model: type[BaseModel]):
+    """
+    Build a dependency that validates the raw request body against a Pydantic model.
+
+    The body is parsed and validated in one pass by pydantic-core, instead of being decoded with json.loads first.
+
+    Args:
+        model (type[BaseModel]): The model of the request body.
+
+    Returns:
+        Callable: The dependency returning the validated model.
+    """
+    async def dependency(request: Request) -> BaseModel:
+        try:
+            return model.model_validate_json(await request.body())
+        except ValidationError as e:
+            raise RequestValidationError(
+                [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)])
+    return dependency
 
 
 @app.get("/")
@@ -72,187 +99,131 @@ async def read_root(request: Request):
 def health_check():
     return {"status": "healthy"}
 
-class UserIdentifierRequest(BaseModel):
-    user_identifier: str
-
-
-class RecentTransactionsResponse(BaseModel):
-    transactions: dict
-
 
 @app.post("/fetch-recent-transactions-for-user", response_model=RecentTransactionsResponse)
-async def fetch_recent_transactions_for_user(request: Request, user_data: UserIdentifierRequest):
+async def fetch_recent_transactions_for_user(user_data: UserIdentifierRequest = Depends(json_body(UserIdentifierRequest))):
     """
     Retrieve recent transactions for a specific user by UserName or ID.
 
     Args:
-        request (Request): The request object containing the user_identifier.
         user_data (UserIdentifierRequest): The user identifier data.
 
     Returns:
         RecentTransactionsResponse: A dictionary containing a list of recent transactions associated with the user.
     """
     try:
-        data = await request.json()
-        user_identifier = data.get("user_identifier")
+        user_identifier = user_data.user_identifier
         if not user_identifier:
             raise HTTPException(
                 status_code=400, detail="User identifier is required")
         if ObjectId.is_valid(user_identifier):
             user_identifier = ObjectId(user_identifier)
         # Validate if the user exists
-        if not transactions_service.is_valid_user(user_identifier):
+        if not await transactions_service.is_valid_user(user_identifier):
             raise HTTPException(
                 status_code=404, detail="User not found")
-        transactions = transactions_service.get_recent_transactions_for_user(
+        transactions = await transactions_service.get_recent_transactions_for_user(
             user_identifier)
-        if transactions:
-            logging.info(
-                f"Found {len(transactions)} recent transactions for user {user_identifier}")
-            return Response(content=json.dumps({"transactions": transactions}, cls=MyJSONEncoder), media_type="application/json")
-        else:
-            logging.info(
-                f"No recent transactions found for user {user_identifier}")
-            return Response(content=json.dumps({"transactions": []}, cls=MyJSONEncoder), media_type="application/json")
+        logger.info(
+            "Found recent transactions.",
+            extra={"user_identifier": str(user_identifier), "transactions_count": len(transactions)})
+        return Response(content=orjson.dumps({"transactions": transactions}, default=orjson_default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z), media_type="application/json")
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        logging.error(
-            f"Error retrieving recent transactions for user: {str(e)}")
+        logger.error(
+            "Error retrieving recent transactions for user: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
-class AccountTransferRequest(BaseModel):
-    account_id_sender: str
-    account_id_receiver: str
-    transaction_amount: float
-    sender_user_id: str
-    sender_user_name: str
-    sender_account_number: str
-    sender_account_type: str
-    receiver_user_id: str
-    receiver_user_name: str
-    receiver_account_number: str
-    receiver_account_type: str
-
-
-class AccountTransferResponse(BaseModel):
-    message: str
-    transaction_id: str
-
-
 @app.post("/perform-account-transfer", response_model=AccountTransferResponse)
-async def perform_account_transfer(request: Request, transfer_data: AccountTransferRequest):
+async def perform_account_transfer(transfer_data: AccountTransferRequest = Depends(json_body(AccountTransferRequest))):
     """
     Perform an account transfer transaction.
 
     Args:
-        request (Request): The request object containing transaction data.
         transfer_data (AccountTransferRequest): The transfer data.
 
     Returns:
         AccountTransferResponse: A dictionary indicating success with the transaction ID.
     """
     try:
-        data = await request.json()
-        transaction_amount = validate_transaction_amount(data)
-
-        transaction_id = transactions_service.perform_transaction(
-            account_id_sender=data["account_id_sender"],
-            account_id_receiver=data["account_id_receiver"],
-            transaction_amount=transaction_amount,
-            sender_user_id=data["sender_user_id"],
-            sender_user_name=data["sender_user_name"],
-            sender_account_number=data["sender_account_number"],
-            sender_account_type=data["sender_account_type"],
-            receiver_user_id=data["receiver_user_id"],
-            receiver_user_name=data["receiver_user_name"],
-            receiver_account_number=data["receiver_account_number"],
-            receiver_account_type=data["receiver_account_type"],
+        transaction_id = await transactions_service.perform_transaction(
+            account_id_sender=transfer_data.account_id_sender,
+            account_id_receiver=transfer_data.account_id_receiver,
+            transaction_amount=transfer_data.transaction_amount,
+            sender_user_id=transfer_data.sender_user_id,
+            sender_user_name=transfer_data.sender_user_name,
+            sender_account_number=transfer_data.sender_account_number,
+            sender_account_type=transfer_data.sender_account_type,
+            receiver_user_id=transfer_data.receiver_user_id,
+            receiver_user_name=transfer_data.receiver_user_name,
+            receiver_account_number=transfer_data.receiver_account_number,
+            receiver_account_type=transfer_data.receiver_account_type,
             transaction_type="AccountTransfer"
         )
         if transaction_id:
-            logging.info(
-                f"Account transfer transaction completed successfully with ID: {transaction_id}")
+            logger.info(
+                "Account transfer transaction completed successfully.",
+                extra={"transaction_id": str(transaction_id), "transaction_type": "AccountTransfer"})
             return {"message": "Account transfer transaction completed successfully.", "transaction_id": str(transaction_id)}
         else:
-            logging.error("Account transfer transaction failed.")
+            logger.error("Account transfer transaction failed.")
             raise HTTPException(
                 status_code=400, detail="Account transfer transaction failed.")
     except HTTPException as e:
         raise e
     except Exception as e:
-        logging.error(f"Failed to perform account transfer: {e}")
+        logger.error("Failed to perform account transfer: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
-class DigitalPaymentRequest(BaseModel):
-    account_id_sender: str
-    account_id_receiver: str
-    transaction_amount: float
-    sender_user_id: str
-    sender_user_name: str
-    sender_account_number: str
-    sender_account_type: str
-    receiver_user_id: str
-    receiver_user_name: str
-    receiver_account_number: str
-    receiver_account_type: str
-    payment_method: str
-
-
-class DigitalPaymentResponse(BaseModel):
-    message: str
-    transaction_id: str
-
-
 @app.post("/perform-digital-payment", response_model=DigitalPaymentResponse)
-async def perform_digital_payment(request: Request, payment_data: DigitalPaymentRequest):
+async def perform_digital_payment(payment_data: DigitalPaymentRequest = Depends(json_body(DigitalPaymentRequest))):
     """
     Perform a digital payment transaction.
 
     Args:
-        request (Request): The request object containing payment data.
         payment_data (DigitalPaymentRequest): The payment data.
 
     Returns:
         DigitalPaymentResponse: A dictionary indicating success with the transaction ID.
     """
     try:
-        data = await request.json()
-        transaction_amount = validate_transaction_amount(data)
-
         # Validate payment method
-        payment_method = data.get("payment_method")
+        payment_method = payment_data.payment_method
         if not payment_method or payment_method == "N/A":
             raise HTTPException(
                 status_code=400,
                 detail="Payment method must be selected for a digital payment."
             )
 
-        transaction_id = transactions_service.perform_transaction(
-            account_id_sender=data["account_id_sender"],
-            account_id_receiver=data["account_id_receiver"],
-            transaction_amount=transaction_amount,
-            sender_user_id=data["sender_user_id"],
-            sender_user_name=data["sender_user_name"],
-            sender_account_number=data["sender_account_number"],
-            sender_account_type=data["sender_account_type"],
-            receiver_user_id=data["receiver_user_id"],
-            receiver_user_name=data["receiver_user_name"],
-            receiver_account_number=data["receiver_account_number"],
-            receiver_account_type=data["receiver_account_type"],
+        transaction_id = await transactions_service.perform_transaction(
+            account_id_sender=payment_data.account_id_sender,
+            account_id_receiver=payment_data.account_id_receiver,
+            transaction_amount=payment_data.transaction_amount,
+            sender_user_id=payment_data.sender_user_id,
+            sender_user_name=payment_data.sender_user_name,
+            sender_account_number=payment_data.sender_account_number,
+            sender_account_type=payment_data.sender_account_type,
+            receiver_user_id=payment_data.receiver_user_id,
+            receiver_user_name=payment_data.receiver_user_name,
+            receiver_account_number=payment_data.receiver_account_number,
+            receiver_account_type=payment_data.receiver_account_type,
             transaction_type="DigitalPayment",
             payment_method=payment_method
         )
         if transaction_id:
-            logging.info(
-                f"Digital payment transaction completed successfully with ID: {transaction_id}")
+            logger.info(
+                "Digital payment transaction completed successfully.",
+                extra={"transaction_id": str(transaction_id), "transaction_type": "DigitalPayment"})
             return {"message": "Digital payment transaction completed successfully.", "transaction_id": str(transaction_id)}
         else:
-            logging.error("Digital payment transaction failed.")
+            logger.error("Digital payment transaction failed.")
             raise HTTPException(
                 status_code=400, detail="Digital payment transaction failed.")
     except HTTPException as e:
         raise e
     except Exception as e:
-        logging.error(f"Failed to perform digital payment: {e}")
+        logger.error("Failed to perform digital payment: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,57 @@
+from pydantic import BaseModel, ConfigDict, Field
+
+# Maximum amount allowed for a single transaction
+TRANSACTION_LIMIT = 500.0
+
+
+class UserIdentifierRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    user_identifier: str
+
+
+class RecentTransactionsResponse(BaseModel):
+    transactions: dict
+
+
+class AccountTransferRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    account_id_sender: str
+    account_id_receiver: str
+    transaction_amount: float = Field(gt=0, le=TRANSACTION_LIMIT)
+    sender_user_id: str
+    sender_user_name: str
+    sender_account_number: str
+    sender_account_type: str
+    receiver_user_id: str
+    receiver_user_name: str
+    receiver_account_number: str
+    receiver_account_type: str
+
+
+class AccountTransferResponse(BaseModel):
+    message: str
+    transaction_id: str
+
+
+class DigitalPaymentRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    account_id_sender: str
+    account_id_receiver: str
+    transaction_amount: float = Field(gt=0, le=TRANSACTION_LIMIT)
+    sender_user_id: str
+    sender_user_name: str
+    sender_account_number: str
+    sender_account_type: str
+    receiver_user_id: str
+    receiver_user_name: str
+    receiver_account_number: str
+    receiver_account_type: str
+    payment_method: str
+
+
+class DigitalPaymentResponse(BaseModel):
+    message: str
+    transaction_id: str
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Delays in seconds between the attempts of a failed batch
+RETRY_INITIAL_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# Number of attempts made for a batch before it is left to the pending sweep
+RETRY_MAX_ATTEMPTS = 5
+
+
+class BackgroundWorker:
+    """This class processes queued jobs in a background task, with bounded retries.
+
+    Jobs are only queued for transactions that record them as pending, so a job dropped
+    because the queue is full or its retries ran out is queued again by the pending sweep.
+    """
+
+    # Name of the jobs in the log messages
+    job_name = "jobs"
+
+    def __init__(self, maxsize: int = 10_000):
+        """Initialize the BackgroundWorker with a bounded queue.
+
+        Args:
+            maxsize (int): The maximum number of queued jobs. Defaults to 10000.
+
+        Returns:
+            None
+        """
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start the background worker on the running event loop.
+
+        Returns:
+            None
+        """
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Wait for the queued jobs to be processed, then stop the background worker.
+
+        Jobs still queued after the timeout stay pending on their transactions and are queued again by the pending sweep.
+
+        Args:
+            timeout (float): The maximum time in seconds to wait for the queued jobs. Defaults to 10.
+
+        Returns:
+            None
+        """
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with unprocessed %s.", self.job_name, extra={"pending_count": self._queue.qsize()})
+        self._worker.cancel()
+        self._worker = None
+
+    def _enqueue(self, job: tuple) -> bool:
+        """Queue a job without waiting, so a stalled worker never blocks the transactions producing jobs.
+
+        Args:
+            job (tuple): The job to queue.
+
+        Returns:
+            bool: True if the job was queued, False if the queue is full and the job is left to the pending sweep.
+        """
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning("Queue full, %s left to the pending sweep.", self.job_name,
+                           extra={"pending_count": self._queue.qsize()})
+            return False
+        return True
+
+    async def _next_batch(self) -> list[tuple]:
+        """Wait for the next batch of jobs to process. By default each job is its own batch.
+
+        Returns:
+            list[tuple]: The jobs of the batch.
+        """
+        return [await self._queue.get()]
+
+    async def _process(self, batch: list[tuple]) -> None:
+        """Process a batch of jobs. Implemented by the subclasses, and safe to run again on the same batch.
+
+        Args:
+            batch (list[tuple]): The jobs of the batch.
+
+        Returns:
+            None
+        """
+        raise NotImplementedError
+
+    def _log_extra(self, batch: list[tuple]) -> dict:
+        """Describe a batch in the log messages of its failed attempts.
+
+        Args:
+            batch (list[tuple]): The jobs of the batch.
+
+        Returns:
+            dict: The extra fields of the log messages.
+        """
+        return {"jobs_count": len(batch)}
+
+    async def _run(self) -> None:
+        """Process the queued batches until the worker is cancelled.
+
+        A failed batch is retried with an exponential backoff, up to RETRY_MAX_ATTEMPTS attempts.
+        It is then dropped, so one failing batch cannot hold up the jobs queued after it.
+
+        Returns:
+            None
+        """
+        while True:
+            batch = await self._next_batch()
+            retry_delay = RETRY_INITIAL_DELAY
+            try:
+                for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+                    try:
+                        await self._process(batch)
+                        break
+                    except Exception as e:
+                        if attempt == RETRY_MAX_ATTEMPTS:
+                            logger.error("Failed to process %s after %s attempts, left to the pending sweep: %s",
+                                         self.job_name, attempt, e, extra=self._log_extra(batch))
+                            break
+                        logger.error("Failed to process %s, retrying in %s s: %s", self.job_name, retry_delay, e,
+                                     extra=self._log_extra(batch))
+                        await asyncio.sleep(retry_delay)
+                        retry_delay = min(retry_delay * 2, RETRY_MAX_DELAY)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
@@ -0,0 +1,109 @@
+from bson import ObjectId
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import BulkWriteError
+
+from services.background_worker import BackgroundWorker
+
+# Server error code of a duplicate key
+DUPLICATE_KEY_ERROR = 11000
+
+
+class NotificationsQueue(BackgroundWorker):
+    """This class delivers transaction notifications in the background, outside the transaction that produced them."""
+
+    job_name = "notifications"
+
+    def __init__(self, notifications_collection: AsyncIOMotorCollection,
+                 transactions_collection: AsyncIOMotorCollection,
+                 on_delivered: Optional[Callable[[tuple], None]] = None, maxsize: int = 10_000):
+        """Initialize the NotificationsQueue with the notifications and transactions collections.
+
+        Args:
+            notifications_collection (AsyncIOMotorCollection): The collection the notifications are inserted into.
+            transactions_collection (AsyncIOMotorCollection): The collection of the transactions marked as notified.
+            on_delivered (Optional[Callable[[tuple], None]]): Called with the IDs and UserNames of the notified users once a transaction is marked as notified.
+            maxsize (int): The maximum number of queued jobs. Defaults to 10000.
+
+        Returns:
+            None
+        """
+        self.notifications_collection = notifications_collection
+        self.transactions_collection = transactions_collection
+        self.on_delivered = on_delivered
+        super().__init__(maxsize)
+
+    def publish(self, transaction_id: ObjectId, notifications: list[dict]) -> bool:
+        """Queue the notifications of a committed transaction for delivery, without waiting for room in the queue.
+
+        Args:
+            transaction_id (ObjectId): The ID of the committed transaction.
+            notifications (list[dict]): The notification documents to insert.
+
+        Returns:
+            bool: True if the job was queued, False if it is left to the pending sweep.
+        """
+        return self._enqueue((transaction_id, notifications))
+
+    async def _process(self, batch: list[tuple]) -> None:
+        """Deliver a batch, which holds a single job.
+
+        Args:
+            batch (list[tuple]): The queued (transaction_id, notifications) job.
+
+        Returns:
+            None
+        """
+        for transaction_id, notifications in batch:
+            await self._deliver(transaction_id, notifications)
+
+    def _log_extra(self, batch: list[tuple]) -> dict:
+        """Describe a batch by the IDs of its transactions.
+
+        Args:
+            batch (list[tuple]): The queued (transaction_id, notifications) jobs.
+
+        Returns:
+            dict: The extra fields of the log messages.
+        """
+        return {"transaction_ids": [str(transaction_id) for transaction_id, _ in batch]}
+
+    async def _deliver(self, transaction_id: ObjectId, notifications: list[dict]) -> None:
+        """Insert the notifications of a transaction and mark the transaction as notified.
+
+        Both steps are idempotent, so a job can be delivered again after a partial failure or a restart.
+
+        Args:
+            transaction_id (ObjectId): The ID of the committed transaction.
+            notifications (list[dict]): The notification documents to insert, with their reserved IDs.
+
+        Returns:
+            None
+        """
+        try:
+            await self.notifications_collection.insert_many(notifications, ordered=False)
+        except BulkWriteError as e:
+            # Notifications inserted by an earlier attempt are rejected by their reserved IDs
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+        await self.transactions_collection.update_one(
+            {"_id": transaction_id, "TransactionNotified": False},
+            {
+                "$set": {"TransactionStatus": "Notified", "TransactionNotified": True},
+                "$push": {
+                    "TransactionDates": {
+                        "TransactionDate": datetime.now(timezone.utc),
+                        "TransactionDateType": "TransactionNotifiedDate",
+                    }
+                },
+                "$unset": {"PendingNotifications": ""},
+            }
+        )
+        if self.on_delivered is not None:
+            user_identifiers = []
+            for notification in notifications:
+                user = notification["NotificationUser"]
+                user_identifiers.extend((user["UserId"], user["UserName"]))
+            self.on_delivered(tuple(user_identifiers))
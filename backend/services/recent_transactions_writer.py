@@ -0,0 +1,130 @@
+import asyncio
+from bson import ObjectId
+from typing import Callable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+
+from services.background_worker import BackgroundWorker
+
+# Number of entries kept in a user's RecentTransactions array
+RECENT_TRANSACTIONS_SIZE = 20
+
+
+def push_recent_transactions_pipeline(items: list[dict]) -> list[dict]:
+    """Build the update pipeline appending entries to a user's RecentTransactions.
+
+    Entries already in the array are replaced instead of added twice, and only the
+    last RECENT_TRANSACTIONS_SIZE entries are kept.
+
+    Args:
+        items (list[dict]): The entries to append, with their TransactionId and Date.
+
+    Returns:
+        list[dict]: The update pipeline.
+    """
+    transaction_ids = [item["TransactionId"] for item in items]
+    kept_transactions = {"$filter": {
+        "input": {"$ifNull": ["$RecentTransactions", []]},
+        "cond": {"$not": {"$in": ["$$this.TransactionId", transaction_ids]}}
+    }}
+    return [{"$set": {"RecentTransactions": {"$slice": [
+        {"$concatArrays": [kept_transactions, {"$literal": items}]},
+        -RECENT_TRANSACTIONS_SIZE
+    ]}}}]
+
+
+class RecentTransactionsWriter(BackgroundWorker):
+    """This class coalesces the RecentTransactions pushes of concurrent transactions into batched writes."""
+
+    job_name = "recent transactions"
+
+    def __init__(self, users_collection: AsyncIOMotorCollection, transactions_collection: AsyncIOMotorCollection,
+                 on_flush: Optional[Callable[[tuple], None]] = None,
+                 flush_interval: float = 0.01, max_batch_size: int = 200, maxsize: int = 10_000):
+        """Initialize the RecentTransactionsWriter with the users and transactions collections.
+
+        Args:
+            users_collection (AsyncIOMotorCollection): The collection holding the RecentTransactions arrays.
+            transactions_collection (AsyncIOMotorCollection): The collection of the transactions marked as recorded.
+            on_flush (Optional[Callable[[tuple], None]]): Called with the IDs and UserNames of the users written by a flush.
+            flush_interval (float): The maximum time in seconds an entry waits for a batch to fill. Defaults to 0.01.
+            max_batch_size (int): The number of entries that triggers a flush. Defaults to 200.
+            maxsize (int): The maximum number of queued entries. Defaults to 10000.
+
+        Returns:
+            None
+        """
+        self.users_collection = users_collection
+        self.transactions_collection = transactions_collection
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        super().__init__(maxsize)
+
+    def submit(self, recent_transaction: dict, users: list[tuple[ObjectId, str]]) -> bool:
+        """Queue the RecentTransactions entry of a transaction for its users, without waiting for room in the queue.
+
+        Args:
+            recent_transaction (dict): The entry to push, with the TransactionId and its Date.
+            users (list[tuple[ObjectId, str]]): The ID and UserName of each user to push the entry to.
+
+        Returns:
+            bool: True if the entry was queued, False if it is left to the pending sweep.
+        """
+        return self._enqueue((recent_transaction, users))
+
+    async def _next_batch(self) -> list[tuple]:
+        """Collect queued entries into a batch.
+
+        A batch is complete once it holds max_batch_size entries or flush_interval has passed since its first entry.
+
+        Returns:
+            list[tuple]: The queued (entry, users) tuples, in submission order.
+        """
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _process(self, batch: list[tuple]) -> None:
+        """Write a batch with one update per user, then mark its transactions as recorded.
+
+        Entries already in a user's array are not added again, so a batch can be written again
+        after a partial failure or a restart.
+
+        Args:
+            batch (list[tuple]): The queued (entry, users) tuples, in submission order.
+
+        Returns:
+            None
+        """
+        grouped = {}
+        user_identifiers = []
+        for recent_transaction, users in batch:
+            for user_oid, user_name in users:
+                if user_oid not in grouped:
+                    grouped[user_oid] = []
+                    user_identifiers.extend((user_oid, user_name))
+                grouped[user_oid].append(recent_transaction)
+
+        await self.users_collection.bulk_write(
+            [UpdateOne({"_id": user_oid}, push_recent_transactions_pipeline(items))
+             for user_oid, items in grouped.items()],
+            ordered=False
+        )
+        await self.transactions_collection.update_many(
+            {"_id": {"$in": [recent_transaction["TransactionId"] for recent_transaction, _ in batch]}},
+            {"$unset": {"PendingRecentTransactions": ""}}
+        )
+
+        if self.on_flush is not None:
+            self.on_flush(tuple(user_identifiers))
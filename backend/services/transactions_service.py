@@ -1,26 +1,181 @@
+import asyncio
 from bson import ObjectId
 from typing import Union
-from pymongo.client_session import ClientSession
-from datetime import datetime, timezone
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import ReadPreference
+from pymongo.write_concern import WriteConcern
+from cachetools import TTLCache
+from motor.motor_asyncio import AsyncIOMotorClientSession
+from datetime import datetime, timedelta, timezone
 import logging
 from database.connection import MongoDBConnection
+from schemas import TRANSACTION_LIMIT
+from services.notifications_queue import NotificationsQueue
+from services.recent_transactions_writer import RecentTransactionsWriter
 
 from typing import Optional
 
-# Configure logging
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Name of the index on users.UserName, used to hint the lookups by UserName
+USER_NAME_INDEX = "UserName_1"
+
+# Options of the transfer transactions: snapshot reads from the primary, majority writes,
+# and a bounded wait for the write concern and the commit
+TRANSACTION_OPTIONS = {
+    "read_concern": ReadConcern("snapshot"),
+    "write_concern": WriteConcern(w="majority", wtimeout=5000),
+    "read_preference": ReadPreference.PRIMARY,
+    "max_commit_time_ms": 5000,
+}
+
+# Interval in seconds between the sweeps that queue the pending jobs of committed transactions again
+PENDING_SWEEP_INTERVAL = 60.0
+# Age in seconds a pending transaction must reach before a sweep queues it again,
+# so the jobs still queued or retrying by a worker are left alone
+PENDING_SWEEP_MIN_AGE = 60.0
+
+# Notification events and message templates, keyed by transaction type and recipient role
+_NOTIFICATION_TEMPLATES = {
+    ("AccountTransfer", "sender"): (
+        "TransferSent",
+        "You have transferred {cur} {amt} to {name}. Your new balance is {cur} {bal}."),
+    ("AccountTransfer", "receiver"): (
+        "TransferReceived",
+        "You have received a transfer of {cur} {amt} from {name}. Your new balance is {cur} {bal}."),
+    ("DigitalPayment", "sender"): (
+        "PaymentMade",
+        "You have made a payment of {cur} {amt} to {name} using {pm}. Your new balance is {cur} {bal}."),
+    ("DigitalPayment", "receiver"): (
+        "PaymentReceived",
+        "You have received a payment of {cur} {amt} from {name} via {pm}. Your new balance is {cur} {bal}."),
+}
+# Internal transactions only notify the sender, whatever their type
+_INTERNAL_TRANSFER_TEMPLATE = ("InternalTransfer", "You have transferred {cur} {amt} internally!")
+
+
+def build_notifications(transaction_type: str, transaction_internal: bool, transaction_id: ObjectId,
+                        transaction_amount: float, payment_method: str, notification_date: datetime,
+                        sender_user: dict, receiver_user: dict, sender_account: dict, receiver_account: dict,
+                        notification_accounts: dict, notification_ids: list[ObjectId]) -> list[dict]:
+    """Build the notification documents for a transaction.
+
+    Args:
+        transaction_type (str): The type of transaction (e.g., AccountTransfer, DigitalPayment).
+        transaction_internal (bool): Whether the transaction is between accounts of the same user.
+        transaction_id (ObjectId): The ID of the transaction document.
+        transaction_amount (float): The transferred amount.
+        payment_method (str): The payment method used if the transaction is a DigitalPayment.
+        notification_date (datetime): The date of the notifications.
+        sender_user (dict): The sender's UserName and UserId.
+        receiver_user (dict): The receiver's UserName and UserId.
+        sender_account (dict): The updated sender account, with AccountCurrency and AccountBalance.
+        receiver_account (dict): The updated receiver account, with AccountCurrency and AccountBalance.
+        notification_accounts (dict): The sender and receiver account references.
+        notification_ids (list[ObjectId]): The IDs of the notifications, the sender's first.
+
+    Returns:
+        list[dict]: A single notification for internal transactions, otherwise the sender and receiver notifications.
+    """
+    def notification(notification_id: ObjectId, event: str, message: str, user: dict) -> dict:
+        return {
+            "_id": notification_id,
+            "NotificationEvent": event,
+            "NotificationMessage": message,
+            "NotificationDate": notification_date,
+            "NotificationUser": user,
+            "NotificationTransaction": {
+                "TransactionId": transaction_id
+            },
+            "NotificationAccounts": notification_accounts
+        }
+
+    sender_currency = sender_account["AccountCurrency"]
+    if transaction_internal:
+        event, template = _INTERNAL_TRANSFER_TEMPLATE
+        return [notification(notification_ids[0], event,
+                             template.format(cur=sender_currency, amt=transaction_amount), sender_user)]
+
+    sender_event, sender_template = _NOTIFICATION_TEMPLATES[(transaction_type, "sender")]
+    receiver_event, receiver_template = _NOTIFICATION_TEMPLATES[(transaction_type, "receiver")]
+    sender_message = sender_template.format(
+        cur=sender_currency, amt=transaction_amount, name=receiver_user["UserName"],
+        bal=sender_account["AccountBalance"], pm=payment_method)
+    receiver_message = receiver_template.format(
+        cur=receiver_account["AccountCurrency"], amt=transaction_amount, name=sender_user["UserName"],
+        bal=receiver_account["AccountBalance"], pm=payment_method)
+    return [notification(notification_ids[0], sender_event, sender_message, sender_user),
+            notification(notification_ids[1], receiver_event, receiver_message, receiver_user)]
+
+
+def build_recent_transaction(transaction: dict) -> tuple[dict, list[tuple[ObjectId, str]]]:
+    """Build the RecentTransactions entry of a transaction from its stored document.
+
+    Args:
+        transaction (dict): The transaction document.
+
+    Returns:
+        tuple[dict, list[tuple[ObjectId, str]]]: The entry, and the ID and UserName of each user to push it to.
+    """
+    sender = transaction["TransactionReferenceData"]["TransactionSender"]
+    receiver = transaction["TransactionReferenceData"]["TransactionReceiver"]
+    recent_transaction = {"TransactionId": transaction["_id"],
+                          "Date": transaction["TransactionDates"][-1]["TransactionDate"]}
+    users = [(sender["UserId"], sender["UserName"])]
+    if not transaction["TransactionDetails"]["TransactionInternal"]:
+        # Internal transactions only update the sender once
+        users.append((receiver["UserId"], receiver["UserName"]))
+    return recent_transaction, users
+
+
+def build_transaction_notifications(transaction: dict) -> list[dict]:
+    """Build the notification documents of a transaction from its stored document.
+
+    Args:
+        transaction (dict): The transaction document, with its PendingNotifications.
+
+    Returns:
+        list[dict]: The notification documents, with the IDs reserved in PendingNotifications.
+    """
+    details = transaction["TransactionDetails"]
+    sender = transaction["TransactionReferenceData"]["TransactionSender"]
+    receiver = transaction["TransactionReferenceData"]["TransactionReceiver"]
+    pending_notifications = transaction["PendingNotifications"]
+    return build_notifications(
+        transaction_type=details["TransactionType"],
+        transaction_internal=details["TransactionInternal"],
+        transaction_id=transaction["_id"],
+        transaction_amount=transaction["TransactionAmount"],
+        payment_method=details.get("TransactionPaymentMethod", "N/A"),
+        notification_date=transaction["TransactionDates"][-1]["TransactionDate"],
+        sender_user={"UserName": sender["UserName"], "UserId": sender["UserId"]},
+        receiver_user={"UserName": receiver["UserName"], "UserId": receiver["UserId"]},
+        sender_account=pending_notifications["SenderAccount"],
+        receiver_account=pending_notifications["ReceiverAccount"],
+        notification_accounts={
+            "AccountIdSender": sender["AccountId"],
+            "AccountNumberSender": sender["AccountNumber"],
+            "AccountTypeSender": sender["AccountType"],
+            "AccountIdReceiver": receiver["AccountId"],
+            "AccountNumberReceiver": receiver["AccountNumber"],
+            "AccountTypeReceiver": receiver["AccountType"]
+        },
+        notification_ids=pending_notifications["NotificationIds"]
+    )
 
 
 class TransactionsService:
     """This class provides methods to perform transactions in the database."""
 
-    def __init__(self, connection: MongoDBConnection, db_name: str):
+    def __init__(self, connection: MongoDBConnection, db_name: str, use_transactions: bool = True):
         """Initialize the TransactionsService with the MongoDB connection and database name.
 
         Args:
             connection (MongoDBConnection): The MongoDB connection instance.
             db_name (str): The name of the database.
+            use_transactions (bool): Whether to wrap each transaction in a multi-document ACID transaction. Defaults to True.
 
         Returns:
             None
@@ -30,57 +185,333 @@ class TransactionsService:
         self.transactions_collection = self.db['transactions']
         self.users_collection = self.db['users']
         self.notifications_collection = self.db['notifications']
+        self.use_transactions = use_transactions
+        # Users are never deleted or renamed by this service, so existing users are cached
+        # as {"_id", "UserName"} documents keyed by both their ObjectId and their UserName
+        self._user_cache = TTLCache(maxsize=10_000, ttl=60)
+        # Identifiers that is_valid_user found to exist, checked without fetching the user
+        self._valid_user_cache = TTLCache(maxsize=10_000, ttl=60)
+        # Set by ensure_indexes once the UserName index is known to exist
+        self._user_name_index_hint: Optional[str] = None
+        # Recent transactions are cached briefly, and evicted once the writer updates a user's RecentTransactions
+        # or the notifications worker marks one of the user's transactions as notified
+        self._recent_transactions_cache = TTLCache(maxsize=10_000, ttl=5)
+        self.recent_transactions_writer = RecentTransactionsWriter(
+            self.users_collection, self.transactions_collection, on_flush=self._evict_recent_transactions)
+        self.notifications_queue = NotificationsQueue(
+            self.notifications_collection, self.transactions_collection,
+            on_delivered=self._evict_recent_transactions)
+        self._pending_sweeper: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Create the indexes and start the background workers and the pending sweep.
 
-    def is_valid_user(self, user_identifier: Union[str, ObjectId]) -> bool:
+        Returns:
+            None
+        """
+        await self.ensure_indexes()
+        self.recent_transactions_writer.start()
+        self.notifications_queue.start()
+        if self._pending_sweeper is None:
+            self._pending_sweeper = asyncio.create_task(self._sweep_pending())
+
+    async def stop(self) -> None:
+        """Stop the pending sweep, write the queued recent transactions and notifications, then stop the background workers.
+
+        Returns:
+            None
+        """
+        if self._pending_sweeper is not None:
+            self._pending_sweeper.cancel()
+            self._pending_sweeper = None
+        await self.recent_transactions_writer.stop()
+        await self.notifications_queue.stop()
+
+    async def ensure_indexes(self) -> None:
+        """Create the indexes used by the user lookups. Creating an existing index is a no-op.
+
+        Returns:
+            None
+        """
+        # is_valid_user and get_recent_transactions_for_user look users up by UserName
+        try:
+            await self.users_collection.create_index([("UserName", 1)], unique=True, name=USER_NAME_INDEX)
+        except OperationFailure as e:
+            # Duplicate UserName values, or a non-unique index from an earlier deployment,
+            # prevent the unique index; a non-unique one still serves the lookups
+            logger.warning("Could not create the unique UserName index: %s", e)
+            try:
+                await self.users_collection.create_index([("UserName", 1)], name=USER_NAME_INDEX)
+            except OperationFailure as e:
+                logger.warning("Could not create the UserName index: %s", e)
+        # The server rejects a hint to a missing index, so lookups only hint an index that exists
+        index_information = await self.users_collection.index_information()
+        self._user_name_index_hint = USER_NAME_INDEX if USER_NAME_INDEX in index_information else None
+        # The pending sweep looks up the transactions whose notifications are not delivered yet
+        await self.transactions_collection.create_index("PendingNotifications", sparse=True)
+        await self.transactions_collection.create_index("PendingRecentTransactions", sparse=True)
+
+    async def _resubmit_pending_recent_transactions(self) -> None:
+        """Queue again the RecentTransactions entries of the transactions that were committed but never recorded.
+
+        This covers the entries lost by a crash, left in the queue at shutdown, dropped by a full queue
+        or given up after their retries. Only transactions older than PENDING_SWEEP_MIN_AGE are queued.
+
+        Returns:
+            None
+        """
+        created_before = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=PENDING_SWEEP_MIN_AGE))
+        pending_count = 0
+        async for transaction in self.transactions_collection.find(
+                {"PendingRecentTransactions": {"$exists": True}, "_id": {"$lt": created_before}},
+                {"TransactionReferenceData": 1, "TransactionDetails.TransactionInternal": 1, "TransactionDates": 1}):
+            # The rest is queued by a later sweep once the writer catches up
+            if not self.recent_transactions_writer.submit(*build_recent_transaction(transaction)):
+                break
+            pending_count += 1
+        if pending_count:
+            logger.info("Resubmitted pending recent transactions.", extra={"transactions_count": pending_count})
+
+    async def _sweep_pending(self) -> None:
+        """Queue again the pending jobs of committed transactions every PENDING_SWEEP_INTERVAL seconds, until cancelled.
+
+        Returns:
+            None
+        """
+        while True:
+            try:
+                await self._resubmit_pending_recent_transactions()
+                await self._republish_pending_notifications()
+            except Exception as e:
+                logger.error("Failed to sweep pending transactions: %s", e)
+            await asyncio.sleep(PENDING_SWEEP_INTERVAL)
+
+    async def _republish_pending_notifications(self) -> None:
+        """Queue again the notifications of the transactions that were committed but never marked as notified.
+
+        This covers the jobs lost by a crash, left in the queue at shutdown, dropped by a full queue
+        or given up after their retries. Only transactions older than PENDING_SWEEP_MIN_AGE are queued.
+
+        Returns:
+            None
+        """
+        created_before = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=PENDING_SWEEP_MIN_AGE))
+        pending_count = 0
+        async for transaction in self.transactions_collection.find(
+                {"PendingNotifications": {"$exists": True}, "_id": {"$lt": created_before}}):
+            # The rest is queued by a later sweep once the worker catches up
+            if not self.notifications_queue.publish(transaction["_id"], build_transaction_notifications(transaction)):
+                break
+            pending_count += 1
+        if pending_count:
+            logger.info("Republished pending notifications.", extra={"transactions_count": pending_count})
+
+    async def _move_funds_without_transaction(self, sender_account_oid: ObjectId, receiver_account_oid: ObjectId,
+                                              transaction_amount: float) -> bool:
+        """Move funds between two accounts without a multi-document transaction.
+
+        The sender debit only applies if the balance covers the amount, and it is reverted if the receiver account does not exist.
+        A failed credit write is not reverted, because the credit may have been applied before the error was raised.
+
+        Args:
+            sender_account_oid (ObjectId): The ID of the sender's account.
+            receiver_account_oid (ObjectId): The ID of the receiver's account.
+            transaction_amount (float): The amount to transfer.
+
+        Returns:
+            bool: True if both accounts were updated, False otherwise.
+        """
+        debit_result = await self.accounts_collection.update_one(
+            {"_id": sender_account_oid, "AccountBalance": {"$gte": transaction_amount}},
+            {"$inc": {"AccountBalance": -transaction_amount}}
+        )
+        if debit_result.matched_count == 0:
+            logger.error("Insufficient funds in sender account.")
+            return False
+
+        try:
+            credit_result = await self.accounts_collection.update_one(
+                {"_id": receiver_account_oid},
+                {"$inc": {"AccountBalance": transaction_amount}}
+            )
+        except Exception as e:
+            logger.critical(
+                "Failed to credit receiver account, the transfer must be reconciled: %s", e,
+                extra={"account_id_sender": str(sender_account_oid),
+                       "account_id_receiver": str(receiver_account_oid),
+                       "transaction_amount": transaction_amount})
+            return False
+
+        if credit_result.matched_count == 0:
+            # Compensate the sender debit
+            await self.accounts_collection.update_one(
+                {"_id": sender_account_oid},
+                {"$inc": {"AccountBalance": transaction_amount}}
+            )
+            logger.error("Receiver account not found, sender debit reverted.")
+            return False
+        return True
+
+    async def _revert_funds_without_transaction(self, transaction_id: ObjectId, sender_account_oid: ObjectId,
+                                                receiver_account_oid: ObjectId, transaction_amount: float) -> None:
+        """Revert a money move made by _move_funds_without_transaction whose transaction could not be recorded.
+
+        A failed insert may still have stored the transaction, so it is deleted first. If it cannot be
+        deleted, the money move is kept rather than leaving a recorded transaction for an undone transfer.
+
+        Args:
+            transaction_id (ObjectId): The ID of the transaction that could not be recorded.
+            sender_account_oid (ObjectId): The ID of the sender's account.
+            receiver_account_oid (ObjectId): The ID of the receiver's account.
+            transaction_amount (float): The transferred amount.
+
+        Returns:
+            None
+        """
+        try:
+            await self.transactions_collection.delete_one({"_id": transaction_id})
+        except Exception as e:
+            logger.critical(
+                "Failed to delete a possibly recorded transaction, money move kept: %s", e,
+                extra={"transaction_id": str(transaction_id),
+                       "account_id_sender": str(sender_account_oid),
+                       "account_id_receiver": str(receiver_account_oid),
+                       "transaction_amount": transaction_amount})
+            return
+        try:
+            await self.accounts_collection.bulk_write(
+                [
+                    UpdateOne({"_id": receiver_account_oid}, {"$inc": {"AccountBalance": -transaction_amount}}),
+                    UpdateOne({"_id": sender_account_oid}, {"$inc": {"AccountBalance": transaction_amount}})
+                ],
+                ordered=False
+            )
+            logger.error("Transaction could not be recorded, money move reverted.")
+        except Exception as e:
+            logger.critical(
+                "Failed to revert money move: %s", e,
+                extra={"account_id_sender": str(sender_account_oid),
+                       "account_id_receiver": str(receiver_account_oid),
+                       "transaction_amount": transaction_amount})
+
+    def _cache_user(self, user: dict) -> None:
+        """Cache a user document by its ObjectId and its UserName.
+
+        Args:
+            user (dict): The user document, with _id and UserName.
+
+        Returns:
+            None
+        """
+        cached_user = {"_id": user["_id"], "UserName": user["UserName"]}
+        self._user_cache[user["_id"]] = cached_user
+        self._user_cache[user["UserName"]] = cached_user
+
+    async def _get_users_by_id(self, user_oids: list[ObjectId]) -> dict:
+        """Get users by ObjectId, querying the database only for the users missing from the cache.
+
+        Args:
+            user_oids (list[ObjectId]): The ObjectIds of the users.
+
+        Returns:
+            dict: The found users, as {"_id", "UserName"} documents keyed by ObjectId.
+        """
+        users = {}
+        missing_oids = []
+        for oid in user_oids:
+            # A single read per user, since an entry can expire between a membership test and a lookup
+            cached_user = self._user_cache.get(oid)
+            if cached_user is None:
+                missing_oids.append(oid)
+            else:
+                users[oid] = cached_user
+        if missing_oids:
+            async for user in self.users_collection.find({"_id": {"$in": missing_oids}}, {"UserName": 1}):
+                self._cache_user(user)
+                users[user["_id"]] = user
+        return users
+
+    def _evict_recent_transactions(self, user_identifiers: tuple) -> None:
+        """Evict users from the recent transactions cache.
+
+        Args:
+            user_identifiers (tuple): The ObjectIds and UserNames of the users.
+
+        Returns:
+            None
+        """
+        for user_identifier in user_identifiers:
+            self._recent_transactions_cache.pop(user_identifier, None)
+
+    async def is_valid_user(self, user_identifier: Union[str, ObjectId]) -> bool:
         """Check if the user exists in the system.
         Args:
             user_identifier (Union[str, ObjectId]): The user identifier (username or ObjectId of the user).
         Returns:
             bool: True if the user exists, False otherwise.
         """
+        if user_identifier in self._user_cache or user_identifier in self._valid_user_cache:
+            return True
+        # Only existence matters, so the count is answered from the index without fetching the document
         if isinstance(user_identifier, ObjectId):
-            user_query = {"_id": user_identifier}
+            user_count = await self.users_collection.count_documents(
+                {"_id": user_identifier}, limit=1, hint="_id_")
         else:
-            user_query = {"UserName": user_identifier}
-        user = self.users_collection.find_one(user_query, {"_id": 1})
-        return user is not None
-
-    def get_recent_transactions_for_user(self, user_identifier: Union[str, ObjectId]) -> list[dict]:
+            hint_option = {"hint": self._user_name_index_hint} if self._user_name_index_hint else {}
+            user_count = await self.users_collection.count_documents(
+                {"UserName": user_identifier}, limit=1, **hint_option)
+        if user_count == 0:
+            return False
+        self._valid_user_cache[user_identifier] = True
+        return True
+
+    async def get_recent_transactions_for_user(self, user_identifier: Union[str, ObjectId]) -> list[dict]:
         """Get the recent transactions for a specific user by UserName or ID.
         Args:
             user_identifier (Union[str, ObjectId]): The UserName or ID of the user.
         Returns:
-            list[dict]: A list of recent transactions for the user.
+            list[dict]: A list of recent transactions for the user, most recent first.
         """
+        # A single read, since an entry can expire between a membership test and a lookup
+        cached_transactions = self._recent_transactions_cache.get(user_identifier)
+        if cached_transactions is not None:
+            return cached_transactions
         # Determining if the identifier is an ObjectId or a username
         if isinstance(user_identifier, ObjectId):
             user_query = {"_id": user_identifier}
         else:
             user_query = {"UserName": user_identifier}
-        # Fetching the user document
-        user = self.users_collection.find_one(
-            user_query, {"RecentTransactions": 1})
-        if not user or "RecentTransactions" not in user:
-            logging.info(
-                f"No recent transactions found for user {user_identifier}")
-            return []
-        # Extracting the recent transaction IDs, sorted by date descending and limited to 20
-        recent_transactions = sorted(
-            user["RecentTransactions"], key=lambda x: x["Date"], reverse=True)[:20]
-        transaction_ids = [txn["TransactionId"] for txn in recent_transactions]
-        # Fetching the transaction details from the transactions collection
-        transactions = list(self.transactions_collection.find(
-            {"_id": {"$in": transaction_ids}}))
-        # Sorting the transactions by the most recent date in the TransactionDates array
-        transactions.sort(key=lambda x: max(
-            date["TransactionDate"] for date in x["TransactionDates"]), reverse=True)
+        # Sorting the user's RecentTransactions and joining them with their transaction
+        # documents on the server, in a single round trip
+        pipeline = [
+            {"$match": user_query},
+            {"$project": {"RecentTransactions": 1}},
+            {"$unwind": "$RecentTransactions"},
+            {"$sort": {"RecentTransactions.Date": -1}},
+            {"$limit": 20},
+            {"$lookup": {
+                "from": self.transactions_collection.name,
+                "localField": "RecentTransactions.TransactionId",
+                "foreignField": "_id",
+                "as": "Transaction"
+            }},
+            {"$unwind": "$Transaction"},
+            {"$replaceRoot": {"newRoot": "$Transaction"}},
+            # The outbox fields only drive the background delivery
+            {"$project": {"PendingNotifications": 0, "PendingRecentTransactions": 0}}
+        ]
+        transactions = await self.users_collection.aggregate(pipeline).to_list(None)
+        if not transactions:
+            logger.info(
+                "No recent transactions found for user %s", user_identifier)
+        self._recent_transactions_cache[user_identifier] = transactions
         return transactions
 
-    def perform_transaction(self, account_id_receiver: str, account_id_sender: str,
-                            transaction_amount: float, sender_user_id: str, sender_user_name: str,
-                            sender_account_number: str, sender_account_type: str, receiver_user_id: str,
-                            receiver_user_name: str, receiver_account_number: str, receiver_account_type: str,
-                            transaction_type: str, transaction_description: Optional[str] = "N/A", payment_method: Optional[str] = "N/A") -> ObjectId:
+    async def perform_transaction(self, account_id_receiver: str, account_id_sender: str,
+                                  transaction_amount: float, sender_user_id: str, sender_user_name: str,
+                                  sender_account_number: str, sender_account_type: str, receiver_user_id: str,
+                                  receiver_user_name: str, receiver_account_number: str, receiver_account_type: str,
+                                  transaction_type: str, transaction_description: Optional[str] = "N/A", payment_method: Optional[str] = "N/A") -> ObjectId:
         """Perform a transaction between two accounts.
 
         Args:
@@ -103,341 +534,275 @@ class TransactionsService:
             ObjectId: The ID of the transaction document if the transaction is successful, None otherwise
         """
 
+        # Validate the identifiers before touching the database, so a malformed ObjectId
+        # is rejected up front instead of raising InvalidId from a query
+        for name, value in (("sender_user_id", sender_user_id), ("receiver_user_id", receiver_user_id),
+                            ("account_id_sender", account_id_sender), ("account_id_receiver", account_id_receiver)):
+            if not ObjectId.is_valid(value):
+                logger.error("Invalid ObjectId for %s.", name)
+                return None
+
+        # Convert the identifiers once, they are reused by the queries and the callback
+        sender_user_oid = ObjectId(sender_user_id)
+        receiver_user_oid = ObjectId(receiver_user_id)
+        sender_account_oid = ObjectId(account_id_sender)
+        receiver_account_oid = ObjectId(account_id_receiver)
+
         # In Python, type hints (like float in function signature) are not enforced at runtime.
         # This means that even if you specify transaction_amount: float, the actual value passed to the function can still be an integer if it's not explicitly converted to a float.
         # Ensure transaction_amount is a float
         # Validate that transaction_amount is a float
         try:
             transaction_amount = float(transaction_amount)
-        except ValueError:
-            logging.error("Transaction amount must be a float.")
+        except (ValueError, TypeError):
+            logger.error("Transaction amount must be a float.")
             return None
 
         # Check if the transaction amount is valid
         if transaction_amount <= 0:
-            logging.error("Transaction amount must be greater than 0.")
+            logger.error("Transaction amount must be greater than 0.")
             return None
 
-        transaction_limit = float(500)
-
         # Check if the transaction amount exceeds the limit
-        if transaction_amount > transaction_limit:
-            logging.error(
-                f"Transaction amount exceeds the limit of {transaction_limit}.")
+        if transaction_amount > TRANSACTION_LIMIT:
+            logger.error(
+                "Transaction amount exceeds the limit of %s.", TRANSACTION_LIMIT)
+            return None
+
+        if sender_user_name == receiver_user_name and sender_account_number == receiver_account_number:
+            logger.error("Cannot transfer to the same account!")
             return None
 
-        # Retrieve and validate sender account details
-        sender_account = self.accounts_collection.find_one(
-            {"_id": ObjectId(account_id_sender)})
+        # Retrieve both accounts and both users with at most one query per collection, running concurrently,
+        # projecting only the fields used by the validation
+        accounts, users = await asyncio.gather(
+            self.accounts_collection.find(
+                {"_id": {"$in": [sender_account_oid, receiver_account_oid]}},
+                {"AccountBalance": 1, "AccountStatus": 1, "AccountNumber": 1, "AccountType": 1}
+            ).to_list(None),
+            self._get_users_by_id([sender_user_oid, receiver_user_oid])
+        )
+        accounts = {account["_id"]: account for account in accounts}
+
+        # Validate sender account details
+        sender_account = accounts.get(sender_account_oid)
         if not sender_account:
-            logging.error("Sender account not found.")
+            logger.error("Sender account not found.")
             return None
         if sender_account["AccountBalance"] < transaction_amount:
-            logging.error("Insufficient funds in sender account.")
+            logger.error("Insufficient funds in sender account.")
             return None
         if sender_account["AccountStatus"] == "Closed":
-            logging.error("Sender account is closed.")
+            logger.error("Sender account is closed.")
             return None
         if (sender_account["AccountNumber"] != sender_account_number or
                 sender_account["AccountType"] != sender_account_type):
-            logging.error("Sender account details do not match.")
+            logger.error("Sender account details do not match.")
             return None
 
-        # Retrieve and validate sender user details
-        sender_user = self.users_collection.find_one(
-            {"_id": ObjectId(sender_user_id)})
+        # Validate sender user details
+        sender_user = users.get(sender_user_oid)
         if not sender_user or sender_user["UserName"] != sender_user_name:
-            logging.error("Sender user details do not match.")
+            logger.error("Sender user details do not match.")
             return None
 
-        # Retrieve and validate receiver account details
-        receiver_account = self.accounts_collection.find_one(
-            {"_id": ObjectId(account_id_receiver)})
+        # Validate receiver account details
+        receiver_account = accounts.get(receiver_account_oid)
         if not receiver_account:
-            logging.error("Receiver account not found.")
+            logger.error("Receiver account not found.")
             return None
         if receiver_account["AccountStatus"] == "Closed":
-            logging.error("Receiver account is closed.")
+            logger.error("Receiver account is closed.")
             return None
         if (receiver_account["AccountNumber"] != receiver_account_number or
                 receiver_account["AccountType"] != receiver_account_type):
-            logging.error("Receiver account details do not match.")
+            logger.error("Receiver account details do not match.")
             return None
 
-        # Retrieve and validate receiver user details
-        receiver_user = self.users_collection.find_one(
-            {"_id": ObjectId(receiver_user_id)})
+        # Validate receiver user details
+        receiver_user = users.get(receiver_user_oid)
         if not receiver_user or receiver_user["UserName"] != receiver_user_name:
-            logging.error("Receiver user details do not match.")
+            logger.error("Receiver user details do not match.")
             return None
 
-        def callback(session: ClientSession):
-            # Create the transaction document
-
-            if sender_user_name == receiver_user_name and sender_account_number == receiver_account_number:
-                logging.error("Cannot transfer to the same account!")
-                return False
+        # Everything that does not depend on the writes is built once here, since
+        # with_transaction runs the callback again on transient transaction errors
+        transaction_internal = False
+
+        if sender_user_name == receiver_user_name and sender_account_number != receiver_account_number:
+            transaction_internal = True
+
+        # The transaction document, completed with its dates by the callback
+        transaction_template = {
+            "TransactionAmount": transaction_amount,
+            "TransactionDescription": transaction_description,
+            "TransactionDetails": {
+                "TransactionType": transaction_type,
+                "TransactionInternal": transaction_internal,
+            },
+            "TransactionReferenceData": {
+                "TransactionSender": {
+                    "UserId": sender_user_oid,
+                    "UserName": sender_user_name,
+                    "AccountId": sender_account_oid,
+                    "AccountNumber": sender_account_number,
+                    "AccountType": sender_account_type,
+                },
+                "TransactionReceiver": {
+                    "UserId": receiver_user_oid,
+                    "UserName": receiver_user_name,
+                    "AccountId": receiver_account_oid,
+                    "AccountNumber": receiver_account_number,
+                    "AccountType": receiver_account_type,
+                },
+            },
+            "TransactionDates": None,
+            "TransactionStatus": "Completed",
+            "TransactionCompleted": True,
+            "TransactionNotified": False,
+            # Unset by the writer once the transaction is in both users' RecentTransactions
+            "PendingRecentTransactions": True,
+        }
+
+        # Add payment method if it's a DigitalPayment
+        if transaction_type == "DigitalPayment" and payment_method:
+            transaction_template["TransactionDetails"]["TransactionPaymentMethod"] = payment_method
+
+        # Both balance updates commit or abort together, so they are sent in a single round trip
+        balance_ops = [
+            UpdateOne(
+                {"_id": sender_account_oid, "AccountBalance": {"$gte": transaction_amount}},
+                {"$inc": {"AccountBalance": -transaction_amount}}
+            ),
+            UpdateOne(
+                {"_id": receiver_account_oid},
+                {"$inc": {"AccountBalance": transaction_amount}}
+            )
+        ]
 
-            transaction_internal = False
+        # The notification IDs are reserved up front, so a redelivered notification is never inserted twice
+        notification_ids = [ObjectId()] if transaction_internal else [ObjectId(), ObjectId()]
 
-            if sender_user_name == receiver_user_name and sender_account_number != receiver_account_number:
-                transaction_internal = True
+        async def callback(session: Optional[AsyncIOMotorClientSession]):
+            # Capture the transaction date once
+            now = datetime.now(timezone.utc)
 
+            # The transaction is completed within this callback; the notifications
+            # worker marks it as notified once the notifications are delivered.
+            # The template is copied so a retried callback never reuses an inserted _id.
+            # The _id is set before the insert, so a failed insert can be looked up and undone
             transaction = {
-                "TransactionAmount": transaction_amount,
-                "TransactionDescription": transaction_description,
-                "TransactionDetails": {
-                    "TransactionType": transaction_type,
-                    "TransactionInternal": transaction_internal,
-                },
-                "TransactionReferenceData": {
-                    "TransactionSender": {
-                        "UserId": ObjectId(sender_user_id),
-                        "UserName": sender_user_name,
-                        "AccountId": ObjectId(account_id_sender),
-                        "AccountNumber": sender_account_number,
-                        "AccountType": sender_account_type,
-                    },
-                    "TransactionReceiver": {
-                        "UserId": ObjectId(receiver_user_id),
-                        "UserName": receiver_user_name,
-                        "AccountId": ObjectId(account_id_receiver),
-                        "AccountNumber": receiver_account_number,
-                        "AccountType": receiver_account_type,
-                    },
-                },
+                **transaction_template,
+                "_id": ObjectId(),
                 "TransactionDates": [
                     {
-                        "TransactionDate": datetime.now(timezone.utc),
+                        "TransactionDate": now,
                         "TransactionDateType": "TransactionInitiatedDate",
+                    },
+                    {
+                        "TransactionDate": now,
+                        "TransactionDateType": "TransactionCompletedDate",
                     }
                 ],
-                "TransactionStatus": "Initiated",
-                "TransactionCompleted": False,
-                "TransactionNotified": False,
             }
 
-            # Add payment method if it's a DigitalPayment
-            if transaction_type == "DigitalPayment" and payment_method:
-                transaction["TransactionDetails"]["TransactionPaymentMethod"] = payment_method
-
-            # Update sender account: subtract transaction amount from balance
-            sender_result = self.accounts_collection.find_one_and_update(
-                {"_id": ObjectId(account_id_sender)},
-                {
-                    "$inc": {"AccountBalance": -transaction_amount}
-                },
-                session=session,
-                return_document=True
-            )
-            # Update receiver account: add transaction amount to balance
-            receiver_result = self.accounts_collection.find_one_and_update(
-                {"_id": ObjectId(account_id_receiver)},
-                {
-                    "$inc": {"AccountBalance": transaction_amount}
-                },
-                session=session,
-                return_document=True
-            )
-
-            # Add new transaction to 'transactions' collection
-            transaction_id = self.transactions_collection.insert_one(
-                transaction, session=session).inserted_id
-
-            # Update the transaction document with the completed date and status
-            self.transactions_collection.update_one(
-                {"_id": transaction_id},
-                {
-                    "$set": {
-                        "TransactionStatus": "Completed",
-                        "TransactionCompleted": True
-                    },
-                    "$push": {
-                        "TransactionDates": {
-                            "TransactionDate": datetime.now(timezone.utc),
-                            "TransactionDateType": "TransactionCompletedDate"
-                        }
-                    }
-                },
-                session=session
-            )
+            # Update sender and receiver account balances
+            if session is not None:
+                accounts_result = await self.accounts_collection.bulk_write(balance_ops, session=session)
+                if accounts_result.matched_count != 2:
+                    # Raising aborts the transaction
+                    raise Exception("Insufficient funds in sender account.")
+            elif not await self._move_funds_without_transaction(sender_account_oid, receiver_account_oid, transaction_amount):
+                return None
+            try:
+                # Retrieve the updated balances of both accounts in a single round trip,
+                # projecting only the fields used by the notifications
+                updated_accounts = {
+                    account["_id"]: account
+                    async for account in self.accounts_collection.find(
+                        {"_id": {"$in": [sender_account_oid, receiver_account_oid]}},
+                        {"AccountBalance": 1, "AccountCurrency": 1},
+                        session=session
+                    )
+                }
 
-            # Update RecentTransactions
-            if transaction_internal:
-                # Internal transaction, update only once
-                self.users_collection.update_one(
-                    {"_id": ObjectId(sender_user_id)},
-                    {
-                        "$push": {
-                            "RecentTransactions": {
-                                "$each": [{"TransactionId": transaction_id, "Date": datetime.now(timezone.utc)}],
-                                "$slice": -20
-                            }
-                        }
-                    },
-                    session=session
-                )
-            else:
-                # Update RecentTransactions for sender
-                self.users_collection.update_one(
-                    {"_id": ObjectId(sender_user_id)},
-                    {
-                        "$push": {
-                            "RecentTransactions": {
-                                "$each": [{"TransactionId": transaction_id, "Date": datetime.now(timezone.utc)}],
-                                "$slice": -20
-                            }
-                        }
-                    },
-                    session=session
-                )
-                # Update RecentTransactions for receiver
-                self.users_collection.update_one(
-                    {"_id": ObjectId(receiver_user_id)},
-                    {
-                        "$push": {
-                            "RecentTransactions": {
-                                "$each": [{"TransactionId": transaction_id, "Date": datetime.now(timezone.utc)}],
-                                "$slice": -20
-                            }
-                        }
-                    },
-                    session=session
-                )
-
-            # Create notifications
-            notification_date = datetime.now(timezone.utc)
-
-            notification_accounts = {
-                "AccountIdSender": ObjectId(account_id_sender),
-                "AccountNumberSender": sender_account_number,
-                "AccountTypeSender": sender_account_type,
-                "AccountIdReceiver": ObjectId(account_id_receiver),
-                "AccountNumberReceiver": receiver_account_number,
-                "AccountTypeReceiver": receiver_account_type
-            }
-            if transaction_internal:
-                # Internal transaction, create a single notification
-                notification = {
-                    "NotificationEvent": "InternalTransfer",
-                    "NotificationMessage": f"You have transferred {sender_result['AccountCurrency']} {transaction_amount} internally!",
-                    "NotificationDate": notification_date,
-                    "NotificationUser": {
-                        "UserName": sender_user_name,
-                        "UserId": ObjectId(sender_user_id)
+                # The transaction document carries what its notifications need until they are
+                # delivered, so they can be rebuilt if the process stops before delivering them
+                transaction["PendingNotifications"] = {
+                    "NotificationIds": notification_ids,
+                    "SenderAccount": {
+                        "AccountBalance": updated_accounts[sender_account_oid]["AccountBalance"],
+                        "AccountCurrency": updated_accounts[sender_account_oid]["AccountCurrency"],
                     },
-                    "NotificationTransaction": {
-                        "TransactionId": transaction_id
+                    "ReceiverAccount": {
+                        "AccountBalance": updated_accounts[receiver_account_oid]["AccountBalance"],
+                        "AccountCurrency": updated_accounts[receiver_account_oid]["AccountCurrency"],
                     },
-                    "NotificationAccounts": notification_accounts
                 }
-                self.notifications_collection.insert_one(notification, session=session)
-            else:
-                # Create separate notifications for sender and receiver
-                if transaction_type == "AccountTransfer":
-                    sender_notification = {
-                        "NotificationEvent": "TransferSent",
-                        "NotificationMessage": f"You have transferred {sender_result['AccountCurrency']} {transaction_amount} to {receiver_user_name}. Your new balance is {sender_result['AccountCurrency']} {sender_result['AccountBalance']}.",
-                        "NotificationDate": notification_date,
-                        "NotificationUser": {
-                            "UserName": sender_user_name,
-                            "UserId": ObjectId(sender_user_id)
-                        },
-                        "NotificationTransaction": {
-                            "TransactionId": transaction_id
-                        },
-                        "NotificationAccounts": notification_accounts
-                    }
-                    receiver_notification = {
-                        "NotificationEvent": "TransferReceived",
-                        "NotificationMessage": f"You have received a transfer of {receiver_result['AccountCurrency']} {transaction_amount} from {sender_user_name}. Your new balance is {receiver_result['AccountCurrency']} {receiver_result['AccountBalance']}.",
-                        "NotificationDate": notification_date,
-                        "NotificationUser": {
-                            "UserName": receiver_user_name,
-                            "UserId": ObjectId(receiver_user_id)
-                        },
-                        "NotificationTransaction": {
-                            "TransactionId": transaction_id
-                        },
-                        "NotificationAccounts": notification_accounts
-                    }
-                else:  # Assuming the other type is DigitalPayment
-                    sender_notification = {
-                        "NotificationEvent": "PaymentMade",
-                        "NotificationMessage": f"You have made a payment of {sender_result['AccountCurrency']} {transaction_amount} to {receiver_user_name} using {payment_method}. Your new balance is {sender_result['AccountCurrency']} {sender_result['AccountBalance']}.",
-                        "NotificationDate": notification_date,
-                        "NotificationUser": {
-                            "UserName": sender_user_name,
-                            "UserId": ObjectId(sender_user_id)
-                        },
-                        "NotificationTransaction": {
-                            "TransactionId": transaction_id
-                        },
-                        "NotificationAccounts": notification_accounts
-                    }
-                    receiver_notification = {
-                        "NotificationEvent": "PaymentReceived",
-                        "NotificationMessage": f"You have received a payment of {receiver_result['AccountCurrency']} {transaction_amount} from {sender_user_name} via {payment_method}. Your new balance is {receiver_result['AccountCurrency']} {receiver_result['AccountBalance']}.",
-                        "NotificationDate": notification_date,
-                        "NotificationUser": {
-                            "UserName": receiver_user_name,
-                            "UserId": ObjectId(receiver_user_id)
-                        },
-                        "NotificationTransaction": {
-                            "TransactionId": transaction_id
-                        },
-                        "NotificationAccounts": notification_accounts
-                    }
-                self.notifications_collection.insert_many([sender_notification, receiver_notification], session=session)
-
-            # Update the transaction document with the notified date, status, and notification flag
-            self.transactions_collection.update_one(
-                {"_id": transaction_id},
-                {
-                    "$set": {
-                        "TransactionStatus": "Notified",
-                        "TransactionNotified": True
-                    },
-                    "$push": {
-                        "TransactionDates": {
-                            "TransactionDate": datetime.now(timezone.utc),
-                            "TransactionDateType": "TransactionNotifiedDate"
-                        }
-                    }
-                },
-                session=session
-            )
 
-            logging.info("Transaction completed!")
-            return transaction_id
-
-        # Start a client session and execute the transaction
-        with self.db.client.start_session() as session:
-            # Ensure multi-document ACID transactions:
-            # 1. Atomicity:
-            #    - The `with_transaction` method is used to execute a series of operations as a single transaction.
-            #    - If any operation within the transaction fails, all operations are rolled back, ensuring atomicity.
-            #
-            # 2. Consistency:
-            #    - MongoDB ensures the database transitions from one consistent state to another during the transaction.
-            #    - Operations like updating account balances and inserting transaction documents preserve data integrity.
-            #
-            # 3. Isolation:
-            #    - The transaction operates in an isolated environment.
-            #    - Changes are not visible to other operations until the transaction is successfully committed.
-            #
-            # 4. Durability:
-            #    - Transaction changes are written to the oplog of the replica set.
-            #    - Once committed, changes are durable and can endure server failures.
-            #
-            # - The code uses a callback function with `session.with_transaction(callback)` to execute the transaction.
-            # - This includes multiple updates and inserts across different collections (accounts, transactions, users, notifications).
-            # - Wrapping operations in a transaction ensures execution with ACID properties.
-            #
-            # For more details: https://www.mongodb.com/products/capabilities/transactions
+                # Add new transaction to 'transactions' collection
+                await self.transactions_collection.insert_one(transaction, session=session)
+            except Exception:
+                if session is None:
+                    # Without a transaction nothing rolls the money move back,
+                    # so it is reverted before the failure is reported
+                    await self._revert_funds_without_transaction(
+                        transaction["_id"], sender_account_oid, receiver_account_oid, transaction_amount)
+                raise
+
+            logger.info("Transaction completed!")
+            # The notifications and RecentTransactions entries are only built after the commit
+            return transaction
+
+        if not self.use_transactions:
+            # The money move is guarded and compensated per document, and the remaining
+            # writes only append documents that reference the new transaction ID
             try:
-                transaction_id = session.with_transaction(callback)
-                return transaction_id
+                transaction = await callback(None)
             except Exception as e:
-                logging.error(f"Transaction failed: {e}")
+                logger.error("Transaction failed: %s", e)
                 return None
+        else:
+            # Start a client session and execute the transaction
+            async with await self.db.client.start_session() as session:
+                # Ensure multi-document ACID transactions:
+                # 1. Atomicity:
+                #    - The `with_transaction` method is used to execute a series of operations as a single transaction.
+                #    - If any operation within the transaction fails, all operations are rolled back, ensuring atomicity.
+                #
+                # 2. Consistency:
+                #    - MongoDB ensures the database transitions from one consistent state to another during the transaction.
+                #    - Operations like updating account balances and inserting transaction documents preserve data integrity.
+                #
+                # 3. Isolation:
+                #    - The transaction operates in an isolated environment.
+                #    - Changes are not visible to other operations until the transaction is successfully committed.
+                #
+                # 4. Durability:
+                #    - Transaction changes are written to the oplog of the replica set.
+                #    - Once committed, changes are durable and can endure server failures.
+                #
+                # - The code uses a coroutine function with `session.with_transaction(callback)` to execute the transaction.
+                # - This includes multiple updates and inserts across different collections (accounts, transactions).
+                # - Wrapping operations in a transaction ensures execution with ACID properties.
+                #
+                # For more details: https://www.mongodb.com/products/capabilities/transactions
+                try:
+                    transaction = await session.with_transaction(callback, **TRANSACTION_OPTIONS)
+                except Exception as e:
+                    logger.error("Transaction failed: %s", e)
+                    return None
+
+        if transaction is None:
+            return None
+
+        transaction_id = transaction["_id"]
+
+        # A job that cannot be queued stays pending on the transaction for the pending sweep.
+        # RecentTransactions only serves the recent transactions listing, so the pushes of
+        # concurrent transactions are batched after the commit; the writer evicts the cache
+        self.recent_transactions_writer.submit(*build_recent_transaction(transaction))
+        # Notifications are not needed for the transfer to be consistent, so they are
+        # delivered after the commit instead of extending the transaction
+        self.notifications_queue.publish(transaction_id, build_transaction_notifications(transaction))
+        return transaction_id